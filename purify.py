@@ -4,6 +4,8 @@ import sys
 import hmac
 import hashlib
 import secrets
+import time
+import json
 import copy
 import struct
 import math
@@ -63,6 +65,20 @@ def modinv(a, m):
     else:
         return x % m
 
+def batch_modinv(values, m):
+    """Invert all the (non-zero) values modulo m using a single modular inversion."""
+    prefix = []
+    acc = 1
+    for v in values:
+        prefix.append(acc)
+        acc = (acc * v) % m
+    inv = modinv(acc, m)
+    ret = [None] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        ret[i] = (inv * prefix[i]) % m
+        inv = (inv * values[i]) % m
+    return ret
+
 def legendre_symbol(a, p):
     """
     Legendre symbol
@@ -150,6 +166,19 @@ class EllipticCurve:
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
 
+    def batch_affine(self, ps):
+        """Convert a list of points to affine coordinates, sharing a single inversion."""
+        invs = batch_modinv([z1 if z1 != 0 else 1 for (_, _, z1) in ps], self.p)
+        ret = []
+        for ((x1, y1, z1), inv) in zip(ps, invs):
+            if z1 == 0:
+                ret.append(None)
+                continue
+            inv_2 = (inv**2) % self.p
+            inv_3 = (inv_2 * inv) % self.p
+            ret.append(((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1))
+        return ret
+
     def negate(self, p1):
         x1, y1, z1 = p1
         return (x1, (self.p - y1) % self.p, z1)
@@ -248,6 +277,86 @@ class EllipticCurve:
                 r = self.add(r, p1)
         return r
 
+    def ladder_x(self, p1, n):
+        """Compute the affine X coordinate of n * p1 (None for infinity) with an X-only Montgomery ladder.
+
+        Every bit up to the bit length of the group order goes through the same
+        sequence of field operations, and the conditional swaps are arithmetic
+        rather than branches. Python integers themselves are not constant time.
+        """
+        if n >> self.n.bit_length():
+            raise RuntimeError("Scalar out of range for ladder")
+        p, a, b = self.p, self.a, self.b
+        xd = self.affine(p1)[0]
+        # (x0 : z0) starts at infinity, (x1 : z1) at p1; x1/z1 - x0/z0 is always p1
+        x0, z0, x1, z1 = 1, 0, xd, 1
+        swap = 0
+        for i in range(self.n.bit_length() - 1, -1, -1):
+            bit = (n >> i) & 1
+            s = swap ^ bit
+            d = s * (x0 - x1)
+            x0, x1 = x0 - d, x1 + d
+            d = s * (z0 - z1)
+            z0, z1 = z0 - d, z1 + d
+            swap = bit
+            # differential addition (difference xd) and doubling on X/Z coordinates
+            x0z1, x1z0, z0z1 = (x0 * z1) % p, (x1 * z0) % p, (z0 * z1) % p
+            t = (x0z1 - x1z0) ** 2 % p
+            x1 = (2 * (x0z1 + x1z0) * (x0 * x1 + a * z0z1) + 4 * b * z0z1 * z0z1 - xd * t) % p
+            z1 = t
+            x0_2, z0_2 = (x0 * x0) % p, (z0 * z0) % p
+            x0, z0 = ((x0_2 - a * z0_2) ** 2 - 8 * b * x0 * z0_2 * z0) % p, (4 * z0 * (x0_2 * x0 + a * x0 * z0_2 + b * z0_2 * z0)) % p
+        d = swap * (x0 - x1)
+        x0 = x0 - d
+        d = swap * (z0 - z1)
+        z0 = z0 - d
+        if z0 == 0:
+            return None
+        return (x0 * pow(z0, p - 2, p)) % p
+
+    def mul_x(self, p1, n, uniform=False):
+        """Compute the affine X coordinate of n * p1 (None for infinity), with ladder_x if uniform is set."""
+        if uniform:
+            return self.ladder_x(p1, n)
+        r = self.affine(self.mul(p1, n))
+        return r[0] if r is not None else None
+
+class FixedBaseTable:
+    """Precomputed affine multiples of a fixed point, for scalar multiplication with only mixed additions."""
+    def __init__(self, curve, p, bits, window=4):
+        self.curve = curve
+        self.window = window
+        self.bits = bits
+        # row i holds j * 2^(window*i) * p for j in 1..2^window-1
+        size = (1 << window) - 1
+        rows = []
+        base = p
+        for i in range((bits + window - 1) // window):
+            rows.append([base])
+            for j in range(1, size):
+                rows[-1].append(curve.add(rows[-1][-1], base))
+            for j in range(window):
+                base = curve.double(base)
+        flat = curve.batch_affine([q for row in rows for q in row])
+        self.table = [flat[i * size:(i + 1) * size] for i in range(len(rows))]
+
+    def mul(self, n):
+        """Compute n * p as a Jacobian point.
+
+        This is not constant time: it skips zero windows and add_mixed returns
+        early for special cases, so it must not be used where --uniform is
+        required.
+        """
+        if n.bit_length() > self.bits:
+            raise RuntimeError("Scalar out of range for fixed-base table")
+        mask = (1 << self.window) - 1
+        r = (0, 1, 0)
+        for row in self.table:
+            if n & mask:
+                r = self.curve.add_mixed(r, row[(n & mask) - 1])
+            n >>= self.window
+        return r
+
 class Expr:
     def __init__(self, v):
         if isinstance(v, int):
@@ -316,10 +425,10 @@ class Expr:
             return None
         ret = self.const
         for (varname, factor) in self.linear:
-            if varname in m and m[varname] is not None:
-                ret += m[varname] * factor
-            else:
+            val = m.get(varname)
+            if val is None:
                 return None
+            ret += val * factor
         return ret % P
 
     # split in constant and non-constant part
@@ -391,6 +500,17 @@ class Transcript:
     def evaluate(self, e):
         return e.evaluate(self.varmap)
 
+    def fork(self):
+        """Return a copy of this transcript that can be extended independently."""
+        ret = copy.copy(self)
+        ret.varmap = dict(self.varmap)
+        ret.muls = list(self.muls)
+        ret.mul_cache = dict(self.mul_cache)
+        ret.div_cache = dict(self.div_cache)
+        ret.bool_cache = dict(self.bool_cache)
+        ret.eqs = list(self.eqs)
+        return ret
+
 #    def bits(self, e, n):
 #        se = str(e)
 #        if (se, n) in self.bits_cache:
@@ -432,23 +552,39 @@ class BulletproofTranscript:
         is_v = self.replace_and_insert(a, s)
         self.assignments += [(s, a, is_v)]
 
-    def from_transcript(self, t, n_bits):
-        self.n_bits = n_bits
-        # libsecp-zkp bulletproofs require power of 2 muls
-        self.n_muls = 2**math.ceil(math.log(len(t.muls), 2))
-        for (i, (a, b, m)) in enumerate(t.muls):
+    def add_muls(self, muls):
+        """Add the L, R and O assignments of muls, numbered after the multiplications added so far."""
+        for (a, b, m) in muls:
+            i = len(self.assignments) // 3
             # need to copy because the muls elements are the same expressions
             # sometimes, but we rely on being able to change the expressions
-            # independently
-            self.add_assignment("L%i" % i, copy.deepcopy(a))
-            self.add_assignment("R%i" % i, copy.deepcopy(b))
-            self.add_assignment("O%i" % i, copy.deepcopy(m))
+            # independently (replacing .linear, so a shallow copy suffices)
+            self.add_assignment("L%i" % i, copy.copy(a))
+            self.add_assignment("R%i" % i, copy.copy(b))
+            self.add_assignment("O%i" % i, copy.copy(m))
 
-        for i in range(len(t.muls), self.n_muls):
+    def pad(self):
+        # libsecp-zkp bulletproofs require power of 2 muls
+        n = len(self.assignments) // 3
+        self.n_muls = 2**math.ceil(math.log(n, 2))
+        for i in range(n, self.n_muls):
             self.add_assignment("L%i" % i, Expr(0))
             self.add_assignment("R%i" % i, Expr(0))
             self.add_assignment("O%i" % i, Expr(0))
 
+    def from_transcript(self, t, n_bits):
+        self.n_bits = n_bits
+        self.add_muls(t.muls)
+        self.pad()
+
+    def fork(self):
+        """Return a copy that can be extended with more multiplications independently of this one."""
+        ret = copy.copy(self)
+        ret.assignments = list(self.assignments)
+        ret.constraints = list(self.constraints)
+        ret.vtoA = dict(self.vtoA)
+        return ret
+
     def add_pubkey_and_out(self, pubkey, P1x, P2x, out):
         def a(pk, Px):
             self.replace_expr_v_with_bp_var(Px)
@@ -478,19 +614,31 @@ class BulletproofTranscript:
 
         return ret
 
-    def evaluate(self, m, commitment):
+    def check(self, m, commitment, start=0):
+        """Compute the assignments into m and check them, returning None if all constraints hold or a description of the first failing one.
+
+        The first start multiplications are taken as already checked: their
+        assignments must be in m, as left there by a check of the transcript
+        this one was forked from.
+        """
         m["V0"] = commitment
-        for (v, A)  in self.vtoA.items():
-            m[A] = m[v]
-        for assign in self.assignments:
-            m[assign[0]] = assign[1].evaluate(m)
-        for i in range(self.n_muls):
-            if (m["L%i" %i] * m["R%i" % i]) % P != m["O%i" % i]:
-                return False
-        for con in self.constraints:
+        # assignments only refer to earlier ones (R may use L of the same gate), so store each before the next
+        it = iter(self.assignments[3 * start:])
+        for (i, ((sl, el, _), (sr, er, _), (so, eo, _))) in enumerate(zip(it, it, it), start):
+            l = m[sl] = el.evaluate(m)
+            r = m[sr] = er.evaluate(m)
+            o = m[so] = eo.evaluate(m)
+            if l is None or r is None or o is None:
+                return "multiplication %i: missing witness value" % i
+            if (l * r) % P != o:
+                return "multiplication %i: L%i * R%i != O%i" % (i, i, i, i)
+        for (i, con) in enumerate(self.constraints):
             if con[0].evaluate(m) != con[1].evaluate(m):
-                return False
-        return True
+                return "constraint %i: %s = %s" % (i, con[0], con[1])
+        return None
+
+    def evaluate(self, m, commitment):
+        return self.check(m, commitment) is None
 
     # m has been called with evaluate
     def write_assignment(self, m, f):
@@ -563,6 +711,26 @@ def pack_public(x1, x2):
     """Convert a pair of coordinates to a single integer in range 0..P^2-1."""
     return (x1 + P * x2)
 
+def gen_keys(n, batch=1024, window=None):
+    """Generate n random keypairs, yielding (z, x) tuples of private and packed public key.
+
+    Public keys use fixed-base tables for G1 and G2, and are converted to affine
+    coordinates with a single inversion per batch of keys. Unless given, the
+    table window is chosen from n, so that a few keys do not pay for large tables.
+    """
+    if window is None:
+        # a table row takes 2^window - 1 full additions to build, each costing about four of the mixed additions every key needs per row
+        window = min(range(1, 9), key=lambda w: (N1.bit_length() + w - 1) // w * (4 * ((1 << w) - 1) + n))
+    T1 = FixedBaseTable(E1, G1, N1.bit_length(), window)
+    T2 = FixedBaseTable(E2, G2, N2.bit_length(), window)
+    for start in range(0, n, batch):
+        zs = [secrets.randbelow((N1 - 1) // 2 * (N2 - 1) // 2) for _ in range(min(batch, n - start))]
+        scalars = [unpack_secret(z) for z in zs]
+        # E1 and E2 are both defined over GF(P), so one batch normalizes both
+        ps = E1.batch_affine([T1.mul(z1) for (z1, _) in scalars] + [T2.mul(z2) for (_, z2) in scalars])
+        for (i, z) in enumerate(zs):
+            yield (z, pack_public(ps[i][0], ps[len(zs) + i][0]))
+
 def combine(x1, x2):
     """Combine two x coordinates into the PRF output."""
     u = x1 % P
@@ -685,7 +853,8 @@ def circuit_combine(trans, x1, x2):
     v = x2 * DI
     return trans.div(trans.mul(u + v, trans.mul(u, v) + A) + 2 * B, trans.mul(u - v, u -v))
 
-def circuit_main(trans, M1, M2, z1=None, z2=None):
+def circuit_key(trans, z1=None, z2=None):
+    """Construct the key-dependent part of the circuit: the key bits and the public key X coordinates."""
     z1bitvals = [None for _ in range(N1.bit_length() - 1)]
     z2bitvals = [None for _ in range(N2.bit_length() - 1)]
     if z1 is not None and z2 is not None:
@@ -697,35 +866,106 @@ def circuit_main(trans, M1, M2, z1=None, z2=None):
     n_bits = len(z1bits) + len(z2bits)
     out_P1x = circuit_ec_multiply_x(E1, trans, G1, z1bits)
     out_P2x = circuit_ec_multiply_x(E2, trans, G2, z2bits)
+    return (z1bits, z2bits, out_P1x, out_P2x, n_bits)
+
+def circuit_message(trans, M1, M2, z1bits, z2bits):
+    """Construct the message-dependent part of the circuit, given the key bits from circuit_key."""
     out_x1 = circuit_ec_multiply_x(E1, trans, M1, z1bits)
     out_x2 = circuit_ec_multiply_x(E2, trans, M2, z2bits)
-    return (circuit_combine(trans, out_x1, out_x2), out_P1x, out_P2x, n_bits)
+    return circuit_combine(trans, out_x1, out_x2)
+
+def circuit_main(trans, M1, M2, z1=None, z2=None):
+    z1bits, z2bits, out_P1x, out_P2x, n_bits = circuit_key(trans, z1, z2)
+    return (circuit_message(trans, M1, M2, z1bits, z2bits), out_P1x, out_P2x, n_bits)
+
+class ProverSession:
+    """Prover for many messages under one key, which builds and checks the key-dependent part of the witness once."""
+    def __init__(self, z, uniform=False):
+        self.uniform = uniform
+        self.z1, self.z2 = unpack_secret(z)
+        P1x = E1.mul_x(G1, self.z1, uniform)
+        P2x = E2.mul_x(G2, self.z2, uniform)
+        self.pubkey = pack_public(P1x, P2x)
+        self.trans = Transcript()
+        self.z1bits, self.z2bits, self.P1x, self.P2x, self.n_bits = circuit_key(self.trans, self.z1, self.z2)
+        assert(self.trans.evaluate(self.P1x) == P1x)
+        assert(self.trans.evaluate(self.P2x) == P2x)
+        # key gates come first in the circuit, so their assignments and checked values can be shared
+        self.bT = BulletproofTranscript()
+        self.bT.n_bits = self.n_bits
+        self.bT.add_muls(self.trans.muls)
+        self.witness = dict(self.trans.varmap)
+        err = self.bT.check(self.witness, 0)
+        assert err is None, err
+
+    def prove(self, m):
+        """Return the BulletproofTranscript for message m and a witness that satisfies it."""
+        M1 = hash_to_curve(b"Eval/1/" + m, E1)
+        M2 = hash_to_curve(b"Eval/2/" + m, E2)
+        out_native = combine(E1.mul_x(M1, self.z1, self.uniform), E2.mul_x(M2, self.z2, self.uniform))
+        trans = self.trans.fork()
+        out = circuit_message(trans, M1, M2, self.z1bits, self.z2bits)
+        assert(trans.evaluate(out) == out_native)
+        bT = self.bT.fork()
+        bT.add_muls(trans.muls[len(self.trans.muls):])
+        bT.pad()
+        # add_pubkey_and_out rewrites its arguments, so keep ours intact
+        bT.add_pubkey_and_out(self.pubkey, copy.copy(self.P1x), copy.copy(self.P2x), out)
+        # the key gates' assignments were checked in __init__
+        witness = dict(self.witness)
+        witness.update(trans.varmap)
+        err = bT.check(witness, out_native, len(self.trans.muls))
+        assert err is None, err
+        return (bT, witness)
+
+# --uniform selects the X-only Montgomery ladder for scalar multiplications by secret keys
+uniform = "--uniform" in sys.argv
+if uniform:
+    sys.argv.remove("--uniform")
+    if len(sys.argv) >= 2 and sys.argv[1] not in ("gen", "eval", "prove"):
+        raise RuntimeError("--uniform is not supported by %s" % sys.argv[1])
 
 if len(sys.argv) < 2:
-    print("Usage: %s gen [<seckey>]: generate a key" % __file__)
-    print("       %s eval <seckey> <hexmsg>: evaluate the PRF" % __file__)
+    print("Usage: %s [--uniform] gen [<seckey>]: generate a key" % __file__)
+    print("       %s gen-batch <count> [jsonl|bin]: generate many keys" % __file__)
+    print("       %s [--uniform] eval <seckey> <hexmsg>: evaluate the PRF" % __file__)
     print("       %s verifier <hexmsg>: output verifier circuit for a given message" % __file__)
-    print("       %s prove <hexmsg> <seckey>: produce input for verifier" % __file__)
+    print("       %s [--uniform] prove <hexmsg> <seckey>: produce input for verifier" % __file__)
+    print("       %s bench [<count>]: compare scalar multiplication with and without --uniform" % __file__)
 elif sys.argv[1] == "gen":
     if len(sys.argv) == 2:
         z = secrets.randbelow((N1 - 1) // 2 * (N2 - 1) // 2)
     else:
         z = int(sys.argv[2], 16)
     z1, z2 = unpack_secret(z)
-    P1 = E1.affine(E1.mul(G1, z1))
-    P2 = E2.affine(E2.mul(G2, z2))
+    P1x = E1.mul_x(G1, z1, uniform)
+    P2x = E2.mul_x(G2, z2, uniform)
 
     print("z=%x # private key" % z)
-    print("x=%x # public key" % pack_public(P1[0], P2[0]))
+    print("x=%x # public key" % pack_public(P1x, P2x))
+elif sys.argv[1] == "gen-batch":
+    count = int(sys.argv[2])
+    fmt = sys.argv[3] if len(sys.argv) > 3 else "jsonl"
+    if fmt not in ("jsonl", "bin"):
+        raise RuntimeError("Unknown output format")
+    # binary records are a big-endian private key followed by a big-endian public key
+    zlen = (((N1 - 1) // 2 * (N2 - 1) // 2 - 1).bit_length() + 7) // 8
+    xlen = ((P * P - 1).bit_length() + 7) // 8
+    start = time.perf_counter()
+    for (z, x) in gen_keys(count):
+        if fmt == "bin":
+            sys.stdout.buffer.write(z.to_bytes(zlen, 'big') + x.to_bytes(xlen, 'big'))
+        else:
+            sys.stdout.write(json.dumps({"z": "%x" % z, "x": "%x" % x}) + "\n")
+    elapsed = time.perf_counter() - start
+    sys.stderr.write("generated %i keys in %.3f s (%.1f keys/s)\n" % (count, elapsed, count / elapsed))
 elif sys.argv[1] == "eval":
     z = int(sys.argv[2], 16)
     m = bytes.fromhex(sys.argv[3])
     z1, z2 = unpack_secret(z)
     M1 = hash_to_curve(b"Eval/1/" + m, E1)
     M2 = hash_to_curve(b"Eval/2/" + m, E2)
-    Q1 = E1.affine(E1.mul(M1, z1))
-    Q2 = E2.affine(E2.mul(M2, z2))
-    out = combine(Q1[0], Q2[0])
+    out = combine(E1.mul_x(M1, z1, uniform), E2.mul_x(M2, z2, uniform))
     print("eval: %x" % out)
 elif sys.argv[1] == "verifier":
     m = bytes.fromhex(sys.argv[2])
@@ -743,27 +983,24 @@ elif sys.argv[1] == "verifier":
 elif sys.argv[1] == "prove":
     m = bytes.fromhex(sys.argv[2])
     z = int(sys.argv[3], 16)
-    z1, z2 = unpack_secret(z)
-    M1 = hash_to_curve(b"Eval/1/" + m, E1)
-    M2 = hash_to_curve(b"Eval/2/" + m, E2)
-    P1 = E1.affine(E1.mul(G1, z1))
-    P2 = E2.affine(E2.mul(G2, z2))
-    Q1 = E1.affine(E1.mul(M1, z1))
-    Q2 = E2.affine(E2.mul(M2, z2))
-    out_native = combine(Q1[0], Q2[0])
-    trans = Transcript()
-    out, P1x, P2x, n_bits = circuit_main(trans, M1, M2, z1, z2)
-    assert(trans.evaluate(P1x) == P1[0])
-    assert(trans.evaluate(P2x) == P2[0])
-    assert(trans.evaluate(out) == out_native)
-    pubkey = pack_public(P1[0], P2[0])
-    bT = BulletproofTranscript()
-    bT.from_transcript(trans, n_bits)
-    bT.add_pubkey_and_out(pubkey, P1x, P2x, out)
-    assert(bT.evaluate(trans.varmap, out_native))
+    bT, witness = ProverSession(z, uniform).prove(m)
 
     with open("prove.assn", 'wb') as f:
-        bT.write_assignment(trans.varmap, f)
+        bT.write_assignment(witness, f)
+
+elif sys.argv[1] == "bench":
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for (name, curve, gen) in (("E1", E1, G1), ("E2", E2, G2)):
+        scalars = [1 + secrets.randbelow((curve.n - 1) // 2) for _ in range(count)]
+        start = time.perf_counter()
+        xs = [curve.mul_x(gen, n) for n in scalars]
+        t_mul = time.perf_counter() - start
+        start = time.perf_counter()
+        ladder_xs = [curve.mul_x(gen, n, True) for n in scalars]
+        t_ladder = time.perf_counter() - start
+        assert(xs == ladder_xs)
+        print("%s mul:    %8.1f ops/s" % (name, count / t_mul))
+        print("%s ladder: %8.1f ops/s (%.2fx the time of mul)" % (name, count / t_ladder, t_ladder / t_mul))
 
 else:
     print("Unknown command")